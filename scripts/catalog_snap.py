@@ -4,255 +4,446 @@ Catalog SNAP documents in Supabase.
 
 This script creates source and version records for SNAP statute documents
 and USDA FNS guidance that have been uploaded to R2.
+
+Re-runs skip documents that are unchanged since their last successful
+catalog. Delete data/snap/.hashcache.json to force a full re-catalog.
 """
 
 import hashlib
+import json
+import logging
+import mimetypes
 import os
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
 from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
 
+# orjson is optional - only used if installed
+try:
+    import orjson
 
-def compute_file_hash(filepath: Path) -> str:
-    """Compute SHA-256 hash of file."""
-    sha256_hash = hashlib.sha256()
-    with open(filepath, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Read size for hashing; large enough to amortize per-call overhead on multi-MB files
+CHUNK = 4 * 1024 * 1024
+
+# Ask PostgREST for a single JSON object instead of a one-element array
+SINGLE_OBJECT_HEADERS = {"Accept": "application/vnd.pgrst.object+json"}
+
+# Max pooled connections per host; also caps concurrent per-document requests
+POOL_MAXSIZE = 8
 
+# Sidecar cache of file hashes and last catalog results, stored next to the documents
+HASH_CACHE_FILENAME = ".hashcache.json"
 
-def get_file_size(filepath: Path) -> int:
-    """Get file size in bytes."""
-    return filepath.stat().st_size
+# Pinned MIME types for the formats we archive, since the mimetypes tables
+# vary by host (Python's defaults map .xml to text/xml). Other extensions
+# fall back to mimetypes.
+mimetypes.init()
+_MIME_TYPES = {
+    ".xml": "application/xml",
+    ".pdf": "application/pdf",
+    ".html": "text/html",
+}
+
+# SNAP statutes and USDA FNS guidance, with their files under data/snap
+DOCUMENTS: list[dict] = [
+    # 1. 7 USC Chapter 51 (full chapter)
+    {
+        "path": "us/statute/7/51",
+        "jurisdiction": "us",
+        "doc_type": "statute",
+        "source_url": "https://uscode.house.gov/view.xhtml?req=granuleid:USC-prelim-title7-chapter51&num=0&edition=prelim",
+        "title": "7 USC Chapter 51 - Food Stamp Program (SNAP)",
+        "r2_key": "us/statute/7/51/chapter51.xml",
+        "local_filename": "usc07-chapter51.xml",
+        "is_current": True,
+    },
+    # 2. 7 USC § 2014 (eligibility)
+    {
+        "path": "us/statute/7/51/usc2014",
+        "jurisdiction": "us",
+        "doc_type": "statute",
+        "source_url": "https://uscode.house.gov/view.xhtml?req=granuleid:USC-prelim-title7-section2014&num=0&edition=prelim",
+        "title": "7 USC § 2014 - Eligible households",
+        "r2_key": "us/statute/7/51/usc2014.xml",
+        "local_filename": "usc2014.xml",
+        "is_current": True,
+    },
+    # 3. 7 USC § 2017 (value of allotment)
+    {
+        "path": "us/statute/7/51/usc2017",
+        "jurisdiction": "us",
+        "doc_type": "statute",
+        "source_url": "https://uscode.house.gov/view.xhtml?req=granuleid:USC-prelim-title7-section2017&num=0&edition=prelim",
+        "title": "7 USC § 2017 - Value of allotment",
+        "r2_key": "us/statute/7/51/usc2017.xml",
+        "local_filename": "usc2017.xml",
+        "is_current": True,
+    },
+    # 4. SNAP FY2024 COLA guidance
+    {
+        "path": "us/guidance/usda/fns/snap-fy2024-cola",
+        "jurisdiction": "us",
+        "doc_type": "guidance",
+        "source_url": "https://www.fns.usda.gov/snap/fy-2024-cola",
+        "title": "SNAP FY 2024 Cost-of-Living Adjustments",
+        "r2_key": "us/guidance/usda/fns/snap-fy2024-cola.pdf",
+        "local_filename": "snap-fy2024-cola.pdf",
+        "published_at": "2023-08-01",
+        "applies_from_year": 2024,
+        "applies_to_year": 2024,
+        "is_current": False,
+    },
+    # 5. SNAP FY2025 COLA guidance
+    {
+        "path": "us/guidance/usda/fns/snap-fy2025-cola",
+        "jurisdiction": "us",
+        "doc_type": "guidance",
+        "source_url": "https://www.fns.usda.gov/snap/fy-2025-cola",
+        "title": "SNAP FY 2025 Cost-of-Living Adjustments",
+        "r2_key": "us/guidance/usda/fns/snap-fy2025-cola.pdf",
+        "local_filename": "snap-fy2025-cola.pdf",
+        "published_at": "2024-08-01",
+        "applies_from_year": 2025,
+        "applies_to_year": None,  # Still current
+        "is_current": True,
+    },
+]
+
+
+def load_hash_cache(cache_path: Path) -> dict:
+    """Load the hash cache, or return an empty one if missing or unreadable."""
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_hash_cache(cache_path: Path, cache: dict) -> None:
+    """Write the hash cache atomically (temp file + rename)."""
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+
+def compute_file_hash(filepath: Path) -> tuple[str, int]:
+    """Compute SHA-256 hash of file, and count its bytes while reading it.
+
+    This must stay SHA-256: versions.content_hash is defined as the SHA-256 of
+    the file content, and versions are deduplicated on (source_id, content_hash).
+
+    Returns: (hex digest, number of bytes hashed)
+    """
+    sha256_hash = hashlib.sha256()
+    total_bytes = 0
+    # Reuse one buffer for every chunk instead of allocating a new bytes object per read
+    buf = bytearray(CHUNK)
+    mv = memoryview(buf)
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            # Files are read front to back; let the kernel read ahead aggressively
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while n := os.readv(fd, [buf]):
+            sha256_hash.update(mv[:n])
+            total_bytes += n
+    finally:
+        os.close(fd)
+    return sha256_hash.hexdigest(), total_bytes
 
 
 def get_mime_type(filepath: Path) -> str:
     """Get MIME type based on file extension."""
     suffix = filepath.suffix.lower()
-    mime_types = {
-        ".xml": "application/xml",
-        ".pdf": "application/pdf",
-        ".html": "text/html",
+    return _MIME_TYPES.get(suffix) or mimetypes.types_map.get(suffix, "application/octet-stream")
+
+
+def hash_and_meta(filepath: Path, cache: dict = None) -> tuple[str, int, str]:
+    """
+    Get content hash, size and MIME type of a file with a single stat call.
+
+    If a cache dict is given, a cached hash is reused when the file's mtime and
+    size are unchanged, and freshly computed hashes are recorded in it. On a
+    miss the size is the number of bytes actually hashed, so it always matches
+    the hash even if the file changed after the stat.
+
+    Returns: (content_hash, file_size, mime_type)
+    """
+    st = os.stat(filepath)
+    key = str(filepath)
+    entry = cache.get(key) if cache is not None else None
+    if entry and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+        content_hash, file_size = entry["hash"], entry["size"]
+    else:
+        content_hash, file_size = compute_file_hash(filepath)
+        if cache is not None:
+            # Keep any catalog record; it is checked against content_hash separately
+            cache[key] = {
+                **(entry or {}),
+                "mtime_ns": st.st_mtime_ns,
+                "size": file_size,
+                "hash": content_hash,
+            }
+    return content_hash, file_size, get_mime_type(filepath)
+
+
+def get_cached_catalog(entry: dict, supabase_url: str, document: dict) -> dict | None:
+    """
+    Get IDs from the last catalog run if the document has not changed since.
+
+    The document (including its content_hash) and the Supabase project must
+    both match what was cataloged.
+
+    Returns: dict with source_id and version_id, or None
+    """
+    catalog = entry.get("catalog")
+    if catalog and catalog["supabase_url"] == supabase_url and catalog["document"] == document:
+        return {"source_id": catalog["source_id"], "version_id": catalog["version_id"]}
+    return None
+
+
+def encode_json(payload) -> bytes:
+    """Serialize a request body to UTF-8 JSON bytes, using orjson if installed."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(payload)
+    return json.dumps(payload, allow_nan=False).encode()
+
+
+def create_session(service_key: str) -> requests.Session:
+    """Create a Supabase REST session that reuses connections across requests."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE))
+    session.headers.update(
+        {
+            "apikey": service_key,
+            "Authorization": f"Bearer {service_key}",
+            "Content-Type": "application/json",
+            # Upsert on conflict and return the row, so existing rows need no extra GET
+            "Prefer": "return=representation,resolution=merge-duplicates",
+        }
+    )
+    return session
+
+
+def build_source_data(document: dict, now: str) -> dict:
+    """Build the sources row for a document, crawled at ISO timestamp now."""
+    return {
+        "path": document["path"],
+        "jurisdiction": document["jurisdiction"],
+        "doc_type": document["doc_type"],
+        "source_url": document["source_url"],
+        "title": document["title"],
+        "crawl_enabled": True,
+        "last_crawl_at": now,
+    }
+
+
+def build_version_data(document: dict, source_id: str, now: str) -> dict:
+    """Build the versions row for a document, retrieved at ISO timestamp now.
+
+    Every row has the same keys, as PostgREST requires for bulk inserts.
+    """
+    return {
+        "source_id": source_id,
+        "content_hash": document["content_hash"],
+        "r2_key": document["r2_key"],
+        "file_size_bytes": document["file_size"],
+        "mime_type": document["mime_type"],
+        "published_at": document.get("published_at"),
+        "retrieved_at": now,
+        "applies_from_year": document.get("applies_from_year"),
+        "applies_to_year": document.get("applies_to_year"),
+        "is_current": document.get("is_current", True),
     }
-    return mime_types.get(suffix, "application/octet-stream")
 
 
 def catalog_document(
-    supabase_url: str,
-    service_key: str,
-    path: str,
-    jurisdiction: str,
-    doc_type: str,
-    source_url: str,
-    title: str,
-    r2_key: str,
-    local_filepath: Path,
-    published_at: str = None,
-    applies_from_year: int = None,
-    applies_to_year: int = None,
-    is_current: bool = True,
+    session: requests.Session, supabase_url: str, document: dict, now: str
 ) -> dict:
     """
-    Catalog a document in Supabase.
+    Catalog a single document in Supabase.
+
+    The document dict holds path, jurisdiction, doc_type, source_url, title,
+    r2_key, content_hash, file_size and mime_type, plus optional published_at,
+    applies_from_year, applies_to_year and is_current. now is the ISO
+    timestamp recorded as last_crawl_at and retrieved_at.
 
     Returns: dict with source_id and version_id
     """
-    headers = {
-        "apikey": service_key,
-        "Authorization": f"Bearer {service_key}",
-        "Content-Type": "application/json",
-        "Prefer": "return=representation",
-    }
-
-    # 1. Create or get source record
-    source_data = {
-        "path": path,
-        "jurisdiction": jurisdiction,
-        "doc_type": doc_type,
-        "source_url": source_url,
-        "title": title,
-        "crawl_enabled": True,
-        "last_crawl_at": datetime.now().isoformat(),
-    }
+    path = document["path"]
+    content_hash = document["content_hash"]
 
-    # Try to insert, on conflict do nothing and get existing
-    response = requests.post(
+    # 1. Upsert source record
+    response = session.post(
         f"{supabase_url}/rest/v1/sources",
-        headers=headers,
-        json=source_data,
+        headers=SINGLE_OBJECT_HEADERS,
+        params={"on_conflict": "path"},
+        data=encode_json(build_source_data(document, now)),
     )
 
-    if response.status_code == 201:
-        source = response.json()[0]
-        print(f"Created source: {path} (ID: {source['id']})")
-    elif response.status_code == 409:
-        # Already exists, fetch it
-        response = requests.get(
-            f"{supabase_url}/rest/v1/sources",
-            headers=headers,
-            params={"path": f"eq.{path}"},
-        )
-        source = response.json()[0]
-        print(f"Source already exists: {path} (ID: {source['id']})")
-    else:
-        print(f"Error creating source: {response.status_code} {response.text}")
+    if response.status_code != 201:
+        logger.error("Error upserting source: %s %s", response.status_code, response.text)
         return None
 
+    source = response.json()
     source_id = source["id"]
+    logger.debug("Cataloged source: %s (ID: %s)", path, source_id)
 
-    # 2. Compute file metadata
-    content_hash = compute_file_hash(local_filepath)
-    file_size = get_file_size(local_filepath)
-    mime_type = get_mime_type(local_filepath)
-
-    # 3. Create version record
-    version_data = {
-        "source_id": source_id,
-        "content_hash": content_hash,
-        "r2_key": r2_key,
-        "file_size_bytes": file_size,
-        "mime_type": mime_type,
-        "published_at": published_at,
-        "retrieved_at": datetime.now().isoformat(),
-        "applies_from_year": applies_from_year,
-        "applies_to_year": applies_to_year,
-        "is_current": is_current,
-    }
-
-    response = requests.post(
+    # 2. Upsert version record
+    response = session.post(
         f"{supabase_url}/rest/v1/versions",
-        headers=headers,
-        json=version_data,
+        headers=SINGLE_OBJECT_HEADERS,
+        params={"on_conflict": "source_id,content_hash"},
+        data=encode_json(build_version_data(document, source_id, now)),
     )
 
-    if response.status_code == 201:
-        version = response.json()[0]
-        print(
-            f"  Created version: {content_hash[:8]}... (ID: {version['id']})"
-        )
-    elif response.status_code == 409:
-        # Version already exists
-        response = requests.get(
-            f"{supabase_url}/rest/v1/versions",
-            headers=headers,
-            params={
-                "source_id": f"eq.{source_id}",
-                "content_hash": f"eq.{content_hash}",
-            },
-        )
-        version = response.json()[0]
-        print(
-            f"  Version already exists: {content_hash[:8]}... (ID: {version['id']})"
-        )
-    else:
-        print(f"Error creating version: {response.status_code} {response.text}")
+    if response.status_code != 201:
+        logger.error("Error upserting version: %s %s", response.status_code, response.text)
         return {"source_id": source_id}
 
+    version = response.json()
+    logger.debug("  Version: %s... (ID: %s)", content_hash[:8], version["id"])
+
     return {"source_id": source_id, "version_id": version["id"]}
 
 
-def main():
-    """Catalog all SNAP documents."""
-    supabase_url = os.environ["COSILICO_SUPABASE_URL"]
-    service_key = os.environ["COSILICO_SUPABASE_SERVICE_KEY"]
+def catalog_individually(
+    session: requests.Session, supabase_url: str, documents: list[dict], now: str
+) -> list[dict]:
+    """Catalog documents one at a time, running the documents concurrently."""
+    with ThreadPoolExecutor(max_workers=min(len(documents), POOL_MAXSIZE)) as pool:
+        return list(pool.map(partial(catalog_document, session, supabase_url, now=now), documents))
 
-    data_dir = Path(__file__).parent.parent / "data" / "snap"
 
-    results = []
+def catalog_documents(
+    session: requests.Session, supabase_url: str, documents: list[dict], now: str
+) -> list[dict]:
+    """
+    Catalog documents in Supabase with one bulk upsert per table.
 
-    # 1. 7 USC Chapter 51 (full chapter)
-    result = catalog_document(
-        supabase_url=supabase_url,
-        service_key=service_key,
-        path="us/statute/7/51",
-        jurisdiction="us",
-        doc_type="statute",
-        source_url="https://uscode.house.gov/view.xhtml?req=granuleid:USC-prelim-title7-chapter51&num=0&edition=prelim",
-        title="7 USC Chapter 51 - Food Stamp Program (SNAP)",
-        r2_key="us/statute/7/51/chapter51.xml",
-        local_filepath=data_dir / "usc07-chapter51.xml",
-        is_current=True,
-    )
-    results.append(result)
+    Sources and versions are each sent as a single array POST that upserts on
+    the table's unique key. If a bulk call fails, falls back to cataloging
+    each document individually (concurrently across documents) so one bad
+    row does not block the rest.
 
-    # 2. 7 USC § 2014 (eligibility)
-    result = catalog_document(
-        supabase_url=supabase_url,
-        service_key=service_key,
-        path="us/statute/7/51/usc2014",
-        jurisdiction="us",
-        doc_type="statute",
-        source_url="https://uscode.house.gov/view.xhtml?req=granuleid:USC-prelim-title7-section2014&num=0&edition=prelim",
-        title="7 USC § 2014 - Eligible households",
-        r2_key="us/statute/7/51/usc2014.xml",
-        local_filepath=data_dir / "usc2014.xml",
-        is_current=True,
+    Returns: list of dicts with source_id and version_id, in document order
+    """
+    # 1. Upsert all source records
+    response = session.post(
+        f"{supabase_url}/rest/v1/sources",
+        params={"on_conflict": "path"},
+        data=encode_json([build_source_data(document, now) for document in documents]),
     )
-    results.append(result)
+    if response.status_code != 201:
+        logger.warning("Bulk source upsert failed: %s %s", response.status_code, response.text)
+        return catalog_individually(session, supabase_url, documents, now)
 
-    # 3. 7 USC § 2017 (value of allotment)
-    result = catalog_document(
-        supabase_url=supabase_url,
-        service_key=service_key,
-        path="us/statute/7/51/usc2017",
-        jurisdiction="us",
-        doc_type="statute",
-        source_url="https://uscode.house.gov/view.xhtml?req=granuleid:USC-prelim-title7-section2017&num=0&edition=prelim",
-        title="7 USC § 2017 - Value of allotment",
-        r2_key="us/statute/7/51/usc2017.xml",
-        local_filepath=data_dir / "usc2017.xml",
-        is_current=True,
-    )
-    results.append(result)
+    source_ids = {source["path"]: source["id"] for source in response.json()}
 
-    # 4. SNAP FY2024 COLA guidance
-    result = catalog_document(
-        supabase_url=supabase_url,
-        service_key=service_key,
-        path="us/guidance/usda/fns/snap-fy2024-cola",
-        jurisdiction="us",
-        doc_type="guidance",
-        source_url="https://www.fns.usda.gov/snap/fy-2024-cola",
-        title="SNAP FY 2024 Cost-of-Living Adjustments",
-        r2_key="us/guidance/usda/fns/snap-fy2024-cola.pdf",
-        local_filepath=data_dir / "snap-fy2024-cola.pdf",
-        published_at="2023-08-01",
-        applies_from_year=2024,
-        applies_to_year=2024,
-        is_current=False,
+    # 2. Upsert all version records
+    response = session.post(
+        f"{supabase_url}/rest/v1/versions",
+        params={"on_conflict": "source_id,content_hash"},
+        data=encode_json(
+            [
+                build_version_data(document, source_ids[document["path"]], now)
+                for document in documents
+            ]
+        ),
     )
-    results.append(result)
+    if response.status_code != 201:
+        logger.warning("Bulk version upsert failed: %s %s", response.status_code, response.text)
+        return catalog_individually(session, supabase_url, documents, now)
 
-    # 5. SNAP FY2025 COLA guidance
-    result = catalog_document(
-        supabase_url=supabase_url,
-        service_key=service_key,
-        path="us/guidance/usda/fns/snap-fy2025-cola",
-        jurisdiction="us",
-        doc_type="guidance",
-        source_url="https://www.fns.usda.gov/snap/fy-2025-cola",
-        title="SNAP FY 2025 Cost-of-Living Adjustments",
-        r2_key="us/guidance/usda/fns/snap-fy2025-cola.pdf",
-        local_filepath=data_dir / "snap-fy2025-cola.pdf",
-        published_at="2024-08-01",
-        applies_from_year=2025,
-        applies_to_year=None,  # Still current
-        is_current=True,
-    )
-    results.append(result)
+    version_ids = {
+        (version["source_id"], version["content_hash"]): version["id"]
+        for version in response.json()
+    }
+
+    results = []
+    for document in documents:
+        source_id = source_ids[document["path"]]
+        version_id = version_ids[(source_id, document["content_hash"])]
+        results.append({"source_id": source_id, "version_id": version_id})
+    return results
+
+
+def main():
+    """Catalog all SNAP documents."""
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    supabase_url = os.environ["COSILICO_SUPABASE_URL"]
+    service_key = os.environ["COSILICO_SUPABASE_SERVICE_KEY"]
+
+    data_dir = Path(__file__).parent.parent / "data" / "snap"
+
+    filepaths = [data_dir / document["local_filename"] for document in DOCUMENTS]
+
+    # Hash all files up front; hashlib releases the GIL, so threads hash in parallel.
+    # Unchanged files are served from the sidecar cache without being read.
+    cache_path = data_dir / HASH_CACHE_FILENAME
+    hash_cache = load_hash_cache(cache_path)
+    with ThreadPoolExecutor(max_workers=min(len(filepaths), os.cpu_count() or 1)) as pool:
+        file_metadata = list(pool.map(partial(hash_and_meta, cache=hash_cache), filepaths))
+
+    documents = [
+        {**document, "content_hash": content_hash, "file_size": file_size, "mime_type": mime_type}
+        for document, (content_hash, file_size, mime_type) in zip(
+            DOCUMENTS, file_metadata, strict=True
+        )
+    ]
+    cache_entries = [hash_cache[str(filepath)] for filepath in filepaths]
+
+    # Only send documents that changed since their last successful catalog
+    results = [
+        get_cached_catalog(entry, supabase_url, document)
+        for entry, document in zip(cache_entries, documents, strict=True)
+    ]
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    if pending:
+        session = create_session(service_key)
+
+        # One timestamp for the whole run, so every row in the batch agrees
+        now = datetime.now(timezone.utc).isoformat()
+
+        cataloged = catalog_documents(session, supabase_url, [documents[i] for i in pending], now)
+        for i, result in zip(pending, cataloged, strict=True):
+            results[i] = result
+            if result and "version_id" in result:
+                cache_entries[i]["catalog"] = {
+                    "supabase_url": supabase_url,
+                    "document": documents[i],
+                    **result,
+                }
+
+    save_hash_cache(cache_path, hash_cache)
 
     print("\n" + "=" * 70)
     print("CATALOG COMPLETE")
     print("=" * 70)
     print(f"Total documents cataloged: {len(results)}")
+    print(f"Unchanged since last run: {len(results) - len(pending)}")
     print("\nDocument IDs:")
-    for i, result in enumerate(results, 1):
+    for i, (document, result) in enumerate(zip(documents, results, strict=True), 1):
         if result:
             print(
-                f"{i}. Source: {result['source_id']}, Version: {result.get('version_id', 'N/A')}"
+                f"{i}. {document['path']}: Source: {result['source_id']}, "
+                f"Version: {result.get('version_id', 'N/A')}"
             )
+        else:
+            print(f"{i}. {document['path']}: FAILED")
 
 
 if __name__ == "__main__":